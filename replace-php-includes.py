@@ -24,204 +24,323 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import functools
+import mmap
 import os
 import re
-from dataclasses import dataclass
-from typing import Iterable, List, Tuple
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, List, Optional, Tuple
 
 
+# All patterns operate on bytes: PHP keywords and the rewritten punctuation are
+# ASCII, so working on raw bytes end-to-end skips the UTF-8 decode on read and
+# the encode on write, and round-trips non-UTF-8 files untouched.
+
 # Matches a full-line statement (optionally with trailing comments/whitespace).
 # Captures: indent, keyword, argument, trailing
+# Case-insensitivity is scoped to the keyword alternation with (?i:...) — the
+# keywords are the only case-insensitive part of the grammar, and a global
+# IGNORECASE would make the engine case-fold the whole pattern.
 STMT_RE = re.compile(
-    r"""
-    ^(\s*)                                           # indent
-    (include|include_once|require|require_once)      # keyword
-    \s*\(\s*(.*?)\s*\)\s*;                           # ( arg );
-    (\s*(?:(?://|\#|/\*).*)?\s*(?:\?>\s*)?)$         # trailing: ws + optional comment + optional ?>
+    rb"""
+    ^(\s*)                                                # indent
+    ((?i:include|include_once|require|require_once))      # keyword
+    \s*\(\s*(.*?)\s*\)\s*;                                # ( arg );
+    (\s*(?:(?://|\#|/\*).*)?\s*(?:\?>\s*)?)$              # trailing: ws + optional comment + optional ?>
     """,
-    re.IGNORECASE | re.VERBOSE,
+    re.VERBOSE,
 )
 
+# Whole-file variant of STMT_RE for files with no /* ... */ comments at all:
+# every line of the file is matched (and rewritten) in a single C-level pass.
+# This cannot simply reuse STMT_RE.pattern with re.MULTILINE: its \s*/.*
+# tokens would cross newlines and rewrite multi-line statements the per-line
+# path never touches. Instead a match is confined to one line exactly like
+# the per-line split: the line-start anchor is a lookbehind for start of data
+# or a CR/LF (bytes.splitlines also breaks on lone CR, which MULTILINE ^ does
+# not), every whitespace class is [^\S\r\n] (whitespace minus CR/LF), free
+# text is [^\r\n], and the terminator is consumed into the trailing capture
+# and re-emitted by rewrite_line.
+STMT_ML_RE = re.compile(
+    rb"""
+    (?<![^\r\n])([^\S\r\n]*)                              # line start + indent
+    ((?i:include|include_once|require|require_once))      # keyword
+    [^\S\r\n]*\([^\S\r\n]*([^\r\n]*?)[^\S\r\n]*\)[^\S\r\n]*;   # ( arg );
+    ([^\S\r\n]*(?:(?://|\#|/\*)[^\r\n]*)?[^\S\r\n]*(?:\?>[^\S\r\n]*)?(?:\r\n|\r|\n|$))  # trailing + EOL
+    """,
+    re.VERBOSE,
+)
 
-@dataclass
-class CommentState:
-    """Tracks whether we are currently inside a multi-line /* ... */ comment."""
-    in_block: bool = False
+# Lenient check applied to comment-stripped code: the line must contain nothing
+# besides a single include/require(...) statement.
+SAFE_RE = re.compile(
+    rb"^(?i:include|include_once|require|require_once)\s*\(\s*.*?\s*\)\s*;\s*$",
+)
 
+# A closing PHP tag (plus surrounding whitespace) at the end of
+# comment-stripped code, allowed after the statement.
+CLOSE_TAG_RE = re.compile(rb"\s*\?>\s*$")
+
+# Tokenizer for strip_comments_for_code_check: strings, comment openers/closers
+# and runs of uninteresting characters, consumed one token at a time instead of
+# one character at a time. Unterminated strings run to end of line.
+TOKEN_RE = re.compile(
+    rb"""
+    '(?:\\.|[^'\\])*(?:'|$)          # single-quoted string
+    | "(?:\\.|[^"\\])*(?:"|$)        # double-quoted string
+    | //.*                           # line comment
+    | \#.*                           # hash comment
+    | /\*.*?\*/                      # block comment closed on the same line
+    | /\*.*                          # block comment opened, runs to EOL
+    | \*/                            # stray block comment close (kept as code)
+    | .[^'"/#*]*                     # anything else
+    """,
+    re.VERBOSE,
+)
 
-def strip_comments_for_code_check(line: str, state: CommentState) -> Tuple[str, CommentState]:
-    """
-    Remove PHP comments from the line (outside of strings) to detect if there is any extra code.
-    Supports //, #, and /* ... */ (including multi-line block comments via state).
-    Returns (code_without_comments, new_state).
-    """
-    i = 0
-    n = len(line)
-    out = []
-    in_single = False
-    in_double = False
-    escaped = False
-
-    while i < n:
-        ch = line[i]
-        nxt = line[i + 1] if i + 1 < n else ""
-
-        if state.in_block:
-            # Consume until end of block comment
-            if ch == "*" and nxt == "/":
-                state.in_block = False
-                i += 2
-                continue
-            i += 1
-            continue
+# Prefilter prefixes for line_is_safe_single_statement; 'include_once' and
+# 'require_once' are covered by their stems.
+KEYWORD_PREFIXES = (b"include", b"require")
 
-        # Handle escaping inside strings
-        if (in_single or in_double) and not escaped and ch == "\\":
-            escaped = True
-            out.append(ch)
-            i += 1
-            continue
+# Whole-file prefilter: anything worth rewriting contains a keyword followed
+# by an opening parenthesis somewhere.
+PAREN_RE = re.compile(rb"\b(?i:(?:include|require)(?:_once)?)\s*\(")
 
-        # Toggle string states (only when not escaped)
-        if not escaped:
-            if not in_double and ch == "'":
-                in_single = not in_single
-                out.append(ch)
-                i += 1
-                continue
-            if not in_single and ch == '"':
-                in_double = not in_double
-                out.append(ch)
-                i += 1
-                continue
 
-        # Reset escape after consuming a character in string context
-        if escaped:
-            escaped = False
-            out.append(ch)
-            i += 1
-            continue
+def strip_comments_for_code_check(line: bytes, in_block: bool) -> Tuple[bytes, bool]:
+    """
+    Remove PHP comments from the line (outside of strings) to detect if there is any extra code.
+    Supports //, #, and /* ... */ (in_block carries multi-line block comment
+    state between lines).
+    Returns (code_without_comments, new_in_block).
+    """
+    pos = 0
+    if in_block:
+        # Consume until end of block comment
+        end = line.find(b"*/")
+        if end == -1:
+            return b"", True
+        in_block = False
+        pos = end + 2
 
-        # If not inside a string, detect comment starts
-        if not in_single and not in_double:
-            if ch == "/" and nxt == "/":
+    out = []
+    for m in TOKEN_RE.finditer(line, pos):
+        tok = m.group()
+        ch = tok[:1]
+        if ch == b"#":
+            break  # rest is # comment
+        if ch == b"/":
+            if tok.startswith(b"//"):
                 break  # rest is // comment
-            if ch == "#":
-                break  # rest is # comment
-            if ch == "/" and nxt == "*":
-                state.in_block = True
-                i += 2
-                continue
+            if tok.startswith(b"/*"):
+                # len check: in '/*/' the close would overlap the opener
+                if len(tok) >= 4 and tok.endswith(b"*/"):
+                    continue  # block comment closed on this line
+                in_block = True
+                break  # block comment runs past EOL
+        out.append(tok)
 
-        out.append(ch)
-        i += 1
+    return b"".join(out), in_block
 
-    return "".join(out), state
 
-
-def line_is_safe_single_statement(original_line: str, state: CommentState) -> Tuple[bool, bool, CommentState]:
+def line_is_safe_single_statement(
+    original_line: bytes, in_block: bool
+) -> Tuple[bool, Optional[re.Match], bool]:
     """
     Determine if a line contains ONLY one include/require(...) statement + comments/whitespace.
     Returns:
       - is_safe: can rewrite
-      - matches_stmt: line matches include/require(...) syntactically
-      - new_state: updated block comment state after scanning the line
+      - match: the STMT_RE match if the line matches include/require(...)
+        syntactically (so the caller does not have to re-run the regex)
+      - new_in_block: updated block comment state after scanning the line
     """
+    # Cheap prefilter: a rewritable line must begin with one of the keywords
+    # (after indentation), so a single C-level startswith over a lowercased
+    # prefix lets the vast majority of lines skip the regex machinery
+    # entirely. We still have to track block-comment state for the lines we
+    # skip.
+    if not original_line.lstrip()[:7].lower().startswith(KEYWORD_PREFIXES):
+        if in_block or b"/*" in original_line:
+            _, in_block = strip_comments_for_code_check(original_line, in_block)
+        return False, None, in_block
+
     m = STMT_RE.match(original_line)
-    matches_stmt = m is not None
 
-    # Remove comments to see if any extra code exists besides the statement
-    code_wo_comments, new_state = strip_comments_for_code_check(
-        original_line, CommentState(state.in_block)
-    )
+    # Fast path: no open block comment and no '/*' on the line means STMT_RE's
+    # trailing group has already vetted everything after the statement, so the
+    # character-level comment scan is unnecessary.
+    if not in_block and b"/*" not in original_line:
+        return m is not None, m, in_block
+
+    # If it doesn't even match the statement form, we cannot rewrite; we only
+    # still need the comment scan to keep block-comment state current.
+    if m is None:
+        _, new_in_block = strip_comments_for_code_check(original_line, in_block)
+        return False, None, new_in_block
 
-    # If it doesn't even match the statement form, we cannot rewrite
-    if not matches_stmt:
-        return False, False, new_state
+    # Remove comments to see if any extra code exists besides the statement
+    code_wo_comments, new_in_block = strip_comments_for_code_check(original_line, in_block)
 
     # Now check: after stripping comments, the remaining code must be exactly that statement
     # (possibly different spacing/casing, but still only include/require + parentheses + arg + ;)
     # We'll do a lenient regex on the comment-stripped code.
     code = code_wo_comments.strip()
     # Allow a closing PHP tag at the end of the line
-    code = re.sub(r"\s*\?>\s*$", "", code)
-    safe = bool(
-        re.match(
-            r"^(include|include_once|require|require_once)\s*\(\s*.*?\s*\)\s*;\s*$",
-            code,
-            re.IGNORECASE,
-        )
-    )
-
-    return safe, True, new_state
+    code = CLOSE_TAG_RE.sub(b"", code)
+    safe = bool(SAFE_RE.match(code))
 
+    return safe, m, new_in_block
 
-def rewrite_line_if_needed(line: str) -> str:
-    """Rewrite include/require with parentheses into keyword + space + arg + ; keeping trailing comments AND EOL."""
-    # Preserve original end-of-line exactly
-    eol = ""
-    if line.endswith("\r\n"):
-        eol = "\r\n"
-        core = line[:-2]
-    elif line.endswith("\n"):
-        eol = "\n"
-        core = line[:-1]
-    else:
-        core = line
-
-    m = STMT_RE.match(core)
-    if not m:
-        return line
-
-    indent, kw, arg, trailing = m.groups()
 
+def rewrite_line(m: re.Match) -> bytes:
+    """Rewrite a matched include/require into keyword + space + arg + ;
+    keeping trailing comments AND EOL (both captured by the trailing group)."""
     # Keep original keyword casing as in source (kw is matched as-is by regex)
     # Normalize to: "<indent><kw> <arg>;<trailing>"
-    # trailing already includes its leading whitespace (if any)
-    return f"{indent}{kw} {arg};{trailing}{eol}"
+    # trailing already includes its leading whitespace and the line terminator
+    return b"%s%s %s;%s" % m.groups()
+
+
+def count_lines(data: "bytes | mmap.mmap") -> int:
+    """Count lines in a bytes-like object; a final line without a terminating
+    newline still counts. mmap views are consumed in chunks so that skipped
+    files never land on the heap in one piece."""
+    if isinstance(data, bytes):
+        n = data.count(b"\n")
+        return n + (1 if data and not data.endswith(b"\n") else 0)
+
+    n = 0
+    last = b"\n"
+    data.seek(0)
+    while True:
+        chunk = data.read(1 << 20)
+        if not chunk:
+            break
+        n += chunk.count(b"\n")
+        last = chunk[-1:]
+    return n + (1 if last != b"\n" else 0)
 
 
 def process_file(path: str, dry_run: bool, backup: bool) -> Tuple[int, int]:
     """Return (changed_lines, total_lines)."""
-    with open(path, "r", encoding="utf-8", errors="replace") as f:
-        lines = f.readlines()
+    # The whole-file prefilter is one C-level scan for 'include(' /
+    # 'require(' in any casing: it skips not only keyword-free files but also
+    # files whose includes are already paren-less (e.g. a second run over the
+    # same tree). Running it against an mmap view means skipped files are
+    # never materialized on the Python heap at all.
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty file, or a filesystem that cannot mmap: fall back to read.
+            data = f.read()
+            if PAREN_RE.search(data) is None:
+                return 0, count_lines(data)
+        else:
+            with mm:
+                if PAREN_RE.search(mm) is None:
+                    return 0, count_lines(mm)
+                data = mm[:]
+
+    # Fast path: with no block comments anywhere in the file, STMT_RE alone
+    # decides safety (its trailing group only admits whitespace and //, #
+    # comments), so the whole file is rewritten in one C-level subn instead
+    # of line by line. Every match necessarily changes its line.
+    if b"/*" not in data and b"*/" not in data:
+        new_data, changed = STMT_ML_RE.subn(rewrite_line, data)
+        if changed and not dry_run:
+            write_output(path, new_data, backup)
+        return changed, count_lines(data)
 
     changed = 0
-    total = len(lines)
-    out_lines = []
-
-    state = CommentState(in_block=False)
-
-    for line in lines:
-        is_safe, matches_stmt, state = line_is_safe_single_statement(line, state)
-
-        if is_safe and matches_stmt:
-            new_line = rewrite_line_if_needed(line)
+    total = 0
+    in_block = False
+
+    # Accumulate the rewritten file into one contiguous buffer; a single
+    # write beats per-line writes through the buffered-I/O layer.
+    buf = bytearray()
+    for line in data.splitlines(keepends=True):
+        total += 1
+        is_safe, m, in_block = line_is_safe_single_statement(line, in_block)
+        if is_safe and m is not None:
+            new_line = rewrite_line(m)
             if new_line != line:
                 changed += 1
-            out_lines.append(new_line)
-        else:
-            out_lines.append(line)
+            line = new_line
+        buf += line
 
     if changed and not dry_run:
+        write_output(path, buf, backup)
+
+    return changed, total
+
+
+def write_output(path: str, payload: bytes, backup: bool) -> None:
+    """Write the rewritten contents to a temp file and promote it with
+    os.replace, creating a .bak of the original first when requested."""
+    # mkstemp picks a unique name next to the original (a fixed path + '.tmp'
+    # could clobber a user's file of that name) and creates it 0600, so the
+    # original's mode is copied over before the promotion.
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(payload)
+        shutil.copymode(path, tmp_path)
         if backup:
             bak_path = path + ".bak"
             if not os.path.exists(bak_path):
-                with open(bak_path, "w", encoding="utf-8", errors="replace") as b:
-                    b.writelines(lines)
-
-        with open(path, "w", encoding="utf-8", errors="replace") as f:
-            f.writelines(out_lines)
-
-    return changed, total
+                # Hardlink the backup to the original's data: O(1) and zero
+                # extra bytes on disk, and the original path stays intact
+                # until the temp file replaces it. Fall back to a copy where
+                # links are unsupported (e.g. FAT, some network mounts).
+                try:
+                    os.link(path, bak_path)
+                except OSError:
+                    shutil.copyfile(path, bak_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def process_file_task(path: str, dry_run: bool, backup: bool) -> Tuple[str, Optional[Tuple[int, int]]]:
+    """Worker-side wrapper around process_file: return the path with the
+    result, and report per-file I/O errors instead of letting them abort
+    the whole pool."""
+    try:
+        return path, process_file(path, dry_run=dry_run, backup=backup)
+    except OSError as e:
+        print(f"ERROR: {path}: {e}")
+        return path, None
 
 
 def iter_php_files_under_current_dir() -> Iterable[str]:
-    """Yield all *.php files under current directory recursively."""
-    for root, _, files in os.walk("."):
-        for name in files:
-            if name.lower().endswith(".php"):
-                yield os.path.join(root, name)
+    """Yield all *.php files under current directory recursively.
+
+    Uses os.scandir directly rather than os.walk: the DirEntry type info is
+    cached from the directory read, avoiding a second stat per entry.
+    """
+    stack = ["."]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                if entry.name.lower().endswith(".php"):
+                    yield entry.path
 
 
 def normalize_input_files(paths: List[str]) -> List[str]:
@@ -257,6 +376,7 @@ def main() -> None:
     dry_run = args.dry_run
     backup = not args.no_backup
 
+    targets: Iterable[str]
     if args.files:
         targets = normalize_input_files(args.files)
         # Optional: if user passed a non-php file, still allow it, but warn.
@@ -264,24 +384,45 @@ def main() -> None:
             if not t.lower().endswith(".php"):
                 print(f"NOTE: processing non-.php file because it was explicitly provided: {t}")
     else:
-        targets = list(iter_php_files_under_current_dir())
+        # Keep the generator: paths are submitted to the pool as the walk
+        # discovers them, overlapping directory traversal with worker
+        # processing.
+        targets = iter_php_files_under_current_dir()
 
     total_files = 0
     total_changed_files = 0
     total_changed_lines = 0
 
-    for path in targets:
-        total_files += 1
-        try:
-            changed_lines, _ = process_file(path, dry_run=dry_run, backup=backup)
-        except OSError as e:
-            print(f"ERROR: {path}: {e}")
-            continue
-
-        if changed_lines:
-            total_changed_files += 1
-            total_changed_lines += changed_lines
-            print(f"{path}: changed {changed_lines} line(s)")
+    def consume(futures) -> None:
+        nonlocal total_files, total_changed_files, total_changed_lines
+        for fut in futures:
+            total_files += 1
+            path, result = fut.result()
+            if result is None:  # error already reported by the worker
+                continue
+            changed_lines, _ = result
+            if changed_lines:
+                total_changed_files += 1
+                total_changed_lines += changed_lines
+                print(f"{path}: changed {changed_lines} line(s)")
+
+    # Files are independent of each other, so fan the work out across cores.
+    # ex.map would exhaust the whole targets iterable up front; submit with a
+    # bounded in-flight window instead, so discovery really is interleaved
+    # with processing and pending work stays small on huge trees.
+    worker = functools.partial(process_file_task, dry_run=dry_run, backup=backup)
+    max_workers = os.cpu_count() or 1
+    window = max_workers * 4
+    with ProcessPoolExecutor(max_workers=max_workers) as ex:
+        pending = set()
+        for path in targets:
+            pending.add(ex.submit(worker, path))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                consume(done)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            consume(done)
 
     if dry_run:
         print(f"\nDRY RUN: would change {total_changed_lines} line(s) across {total_changed_files}/{total_files} file(s).")